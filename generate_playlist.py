@@ -1,27 +1,97 @@
+import json
 import os
 import sys
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yt_dlp
 
 print("🚀 YouTube HLS Playlist Generator (yt-dlp + redirect resolver)")
 
+MAX_WORKERS = int(os.environ.get("PL_WORKERS", "16"))
+CACHE_FILE = os.environ.get("PL_CACHE", ".hls_cache.json")
+OFFLINE_TTL = int(os.environ.get("PL_OFFLINE_TTL", "120"))
+# A 304 is only consulted once the OFFLINE_TTL entry has expired, so this
+# must exceed OFFLINE_TTL to have any effect: between the two, an unchanged
+# page keeps the channel offline; past it, yt-dlp runs regardless.
+NOT_MODIFIED_MAX_AGE = int(os.environ.get("PL_NOT_MODIFIED_MAX_AGE", "3600"))
+VALIDATOR_KEYS = ("etag", "last_modified")
+
+# Worker threads and the result loop print concurrently; one lock keeps
+# their lines from being glued together.
+_PRINT_LOCK = threading.Lock()
+
+
+def log(msg):
+    with _PRINT_LOCK:
+        print(msg)
+
+# ---------- HTTP session ---------- #
+
+def make_session():
+    """
+    Builds one shared session so redirect lookups reuse pooled connections
+    instead of paying a TLS handshake per channel. Retries 429/5xx.
+    """
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+    )
+    session = requests.Session()
+    for prefix in ("https://", "http://"):
+        session.mount(prefix, HTTPAdapter(
+            max_retries=retries,
+            pool_connections=MAX_WORKERS,
+            pool_maxsize=MAX_WORKERS,
+        ))
+    return session
+
+
+SESSION = make_session()
+
+
 # ---------- Redirect helper ---------- #
 
-def resolve_live_redirect(url):
+def resolve_live_redirect(url, validators=None):
     """
     Resolves /live URLs to their real watch?v=video_id links.
+    Only the final URL is needed, so a HEAD request is enough: no body is
+    downloaded and the pooled connection stays reusable.
+    Sends the previous ETag/Last-Modified, if any, as a conditional request.
+    Returns (url, validators_to_store, not_modified); previous validators
+    are only carried over on a 304 or when the request itself failed.
     """
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
     try:
-        resp = requests.get(url, allow_redirects=True, timeout=10)
+        resp = SESSION.head(url, headers=headers, allow_redirects=True, timeout=10)
         final_url = resp.url
-        if "watch?v=" in final_url:
-            print(f"[DEBUG] Resolved live URL → {final_url}")
-            return final_url
-        return url
+        not_modified = resp.status_code == 304
+        fresh = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
     except Exception as e:
-        print(f"[WARN] Could not resolve redirect for {url}: {e}")
-        return url
+        log(f"[WARN] Could not resolve redirect for {url}: {e}")
+        return url, {k: validators[k] for k in VALIDATOR_KEYS if validators.get(k)}, False
+
+    fresh = {k: v for k, v in fresh.items() if v}
+    if not_modified and not fresh:
+        fresh = {k: validators[k] for k in VALIDATOR_KEYS if validators.get(k)}
+    if "watch?v=" in final_url:
+        return final_url, fresh, not_modified
+    return url, fresh, not_modified
 
 
 # ---------- URL Normalizer ---------- #
@@ -39,101 +109,260 @@ def normalize_to_watch_url(token: str) -> str:
 
 # ---------- yt-dlp Extraction ---------- #
 
-def extract_hls_url(url: str) -> str | None:
+YDL_OPTS = {
+    "quiet": True,
+    "no_warnings": True,
+    "skip_download": True,
+    "format": "best[protocol^=m3u8]/best",
+    "extractor_args": {"youtube": {"skip": ["dash"]}},
+    "geo_bypass": True,
+    "source_address": "0.0.0.0",
+}
+
+# YoutubeDL keeps per-download state, so each worker thread gets its own
+# instance and reuses it for every channel it handles.
+_YDL_LOCAL = threading.local()
+_YDL_ALL = []
+_YDL_LOCK = threading.Lock()
+
+
+def get_ydl():
+    ydl = getattr(_YDL_LOCAL, "ydl", None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(YDL_OPTS)
+        _YDL_LOCAL.ydl = ydl
+        with _YDL_LOCK:
+            _YDL_ALL.append(ydl)
+    return ydl
+
+
+def close_ydls():
+    with _YDL_LOCK:
+        while _YDL_ALL:
+            _YDL_ALL.pop().close()
+
+
+# yt-dlp reports a channel that simply isn't streaming as a DownloadError
+# (wrapping UserNotLive, or an upcoming-stream reason); anything else is
+# treated as a failure rather than "offline".
+OFFLINE_MARKERS = ("not currently live", "live event will begin", "premieres in")
+
+
+def is_offline_error(err):
+    cause = (getattr(err, "exc_info", None) or (None, None))[1]
+    if isinstance(cause, yt_dlp.utils.UserNotLive):
+        return True
+    msg = str(err).lower()
+    return any(marker in msg for marker in OFFLINE_MARKERS)
+
+
+def extract_hls_url(url: str) -> tuple[str | None, bool]:
     """
     Extracts the best playable .m3u8 link from YouTube.
+    Returns (hls, ok); ok is False when extraction failed (bot check,
+    rate limit, network error) rather than the channel having no HLS.
     """
-    ydl_opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "skip_download": True,
-        "format": "bestvideo+bestaudio/best",
-        "geo_bypass": True,
-        "source_address": "0.0.0.0",
-    }
-
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            print(f"[DEBUG] Extracted info for {url}: {info.get('title')}")
+        info = get_ydl().extract_info(url, download=False)
     except yt_dlp.utils.DownloadError as e:
-        print(f"[WARN] yt-dlp could not extract from {url}: {e}")
-        return None
+        log(f"[WARN] yt-dlp could not extract from {url}: {e}")
+        return None, is_offline_error(e)
     except Exception as e:
-        print(f"[WARN] Unexpected error for {url}: {e}")
-        return None
+        log(f"[WARN] Unexpected error for {url}: {e}")
+        return None, False
 
-    # Find HLS formats
+    # Find the highest-bitrate HLS format in one pass (ties go to the
+    # later format, as with the previous stable sort)
     formats = info.get("formats", []) or []
-    hls_candidates = []
+    best_tbr, best_link = -1, None
     for f in formats:
         proto = f.get("protocol") or ""
         link = f.get("url")
         if not link:
             continue
         if "m3u8" in proto or (".m3u8" in link):
-            hls_candidates.append((f.get("tbr", 0) or 0, link))
+            tbr = f.get("tbr", 0) or 0
+            if tbr >= best_tbr:
+                best_tbr, best_link = tbr, link
 
-    if hls_candidates:
-        hls_candidates.sort(key=lambda x: x[0])
-        return hls_candidates[-1][1]
+    if best_link:
+        return best_link, True
 
     # Fallback: sometimes the 'url' key itself is an HLS link
     if isinstance(info.get("url"), str) and ".m3u8" in info["url"]:
-        return info["url"]
+        return info["url"], True
+
+    return None, True
+
+
+# ---------- Offline cache ---------- #
+
+def load_cache(path=CACHE_FILE):
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache, keep, path=CACHE_FILE):
+    """
+    Persists unexpired offline entries and page validators for the URLs in
+    `keep`. HLS URLs are never cached since they carry short-lived tokens.
+    """
+    now = time.time()
+    fresh = {
+        k: v for k, v in cache.items()
+        if k in keep and (v.get("exp", 0) > now or any(v.get(x) for x in VALIDATOR_KEYS))
+    }
+    try:
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump(fresh, fh)
+    except OSError as e:
+        print(f"[WARN] Could not write cache {path}: {e}")
+
 
-    return None
+def is_cached_offline(cache, url):
+    entry = cache.get(url, {})
+    return entry.get("state") == "offline" and entry.get("exp", 0) > time.time()
+
+
+def offline_still_trusted(entry):
+    """
+    A 304 only confirms the page is unchanged; trust the earlier offline
+    verdict for at most NOT_MODIFIED_MAX_AGE seconds after it was made.
+    """
+    return (
+        entry.get("state") == "offline"
+        and entry.get("checked", 0) + NOT_MODIFIED_MAX_AGE > time.time()
+    )
 
 
 # ---------- Main generator ---------- #
 
-def generate_m3u8_playlist(input_file="links.txt", output_file="playlist.m3u8"):
-    if not os.path.exists(input_file):
-        print(f"[FATAL] Missing {input_file}.")
-        sys.exit(1)
+def process_channel(url, cache):
+    """
+    Returns (resolved_url, hls, status, validators) where status is one of
+    "live", "offline", "error", "cached" (offline TTL still fresh, no
+    request made; validators is None) or "not_modified" (page answered 304
+    and the offline verdict is recent enough to trust).
+    """
+    entry = cache.get(url, {})
+    if is_cached_offline(cache, url):
+        return url, None, "cached", None
+    resolved, validators, not_modified = resolve_live_redirect(url, entry)
+    if not_modified and offline_still_trusted(entry):
+        return resolved, None, "not_modified", validators
+    hls, ok = extract_hls_url(resolved)
+    if hls:
+        return resolved, hls, "live", validators
+    return resolved, None, "offline" if ok else "error", validators
+
+
+def parse_links(input_file):
+    """
+    Parses 'Name | token' lines into an ordered, deduplicated list of
+    (name, watch_url) jobs.
+    """
+    with open(input_file, "rb") as fh:
+        raw_lines = fh.read().decode("utf-8", "replace").splitlines()
 
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-    lines = ["#EXTM3U", f"# Generated on {now}", "#EXT-X-VERSION:3"]
-    total = 0
-    added = 0
     seen = set()
+    jobs = []
+    for line in raw_lines:
+        raw = line.strip()
+        if not raw or raw.startswith("#"):
+            continue
+        parts = [p.strip() for p in raw.split("|")]
+        if len(parts) != 2:
+            print(f"[SKIP] Malformed line: {raw}")
+            continue
+
+        name, token = parts
+        if token in seen:
+            continue
+        seen.add(token)
+        jobs.append((name, normalize_to_watch_url(token)))
+
+    return jobs
 
-    with open(input_file, "r", encoding="utf-8") as fh:
-        for line in fh:
-            raw = line.strip()
-            if not raw or raw.startswith("#"):
+
+def fetch_hls(jobs, cache):
+    """
+    Looks up every job concurrently and returns one HLS URL (or None) per
+    job, in input order. Updates the offline cache in place.
+    """
+    hls_list = []
+
+    # Redirect resolution and yt-dlp extraction are both network-bound, so
+    # run each channel in the pool; results come back in input order.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = ex.map(lambda u: process_channel(u, cache), [url for _, url in jobs])
+
+        for (name, job_url), (url, hls, status, validators) in zip(jobs, results):
+            hls_list.append(hls)
+            entry = cache.setdefault(job_url, {})
+            if validators is not None:
+                for key in VALIDATOR_KEYS:
+                    entry.pop(key, None)
+                entry.update(validators)
+            if status == "cached":
+                log(f"[CACHE] {name} found offline within the last {OFFLINE_TTL}s, skipping.")
                 continue
-            parts = [p.strip() for p in raw.split("|")]
-            if len(parts) != 2:
-                print(f"[SKIP] Malformed line: {raw}")
+            if status == "not_modified":
+                log(f"[CACHE] {name} page unchanged (304) since last offline check, skipping.")
                 continue
 
-            name, token = parts
-            if token in seen:
+            log(f"[INFO] Processed {name} ({url})")
+            if status == "offline":
+                now = time.time()
+                entry.update(state="offline", exp=now + OFFLINE_TTL, checked=now)
+                log(f"[INFO] No HLS for {name} (not live or restricted).")
                 continue
-            seen.add(token)
-            total += 1
-
-            url = normalize_to_watch_url(token)
-            url = resolve_live_redirect(url)
-
-            print(f"[INFO] Processing {name} ({url})...")
-            hls = extract_hls_url(url)
-            if hls:
-                lines.append(f"#EXTINF:-1,{name}")
-                lines.append("#EXT-X-PROGRAM-ID:1")
-                lines.append(hls)
-                added += 1
-                print(f"[OK] Added HLS for {name}")
+
+            for key in ("state", "exp", "checked"):
+                entry.pop(key, None)
+            if status == "live":
+                log(f"[OK] Added HLS for {name}")
             else:
-                lines.append(f"#EXTINF:-1,{name} (offline)")
-                print(f"[INFO] No HLS for {name} (not live or restricted).")
+                # Failures are retried next run instead of being cached
+                log(f"[INFO] No HLS for {name} (extraction failed).")
 
-    with open(output_file, "w", encoding="utf-8") as out:
-        out.write("\n".join(lines) + "\n")
+    return hls_list
 
-    print(f"[DONE] {added}/{total} entries produced HLS. Wrote '{output_file}'.")
+
+def emit_playlist(jobs, hls_list):
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    lines = ["#EXTM3U", f"# Generated on {now}", "#EXT-X-VERSION:3"]
+    for (name, _), hls in zip(jobs, hls_list):
+        if hls:
+            lines.extend((f"#EXTINF:-1,{name}", hls))
+        else:
+            lines.append(f"#EXTINF:-1,{name} (offline)")
+    return "\n".join(lines) + "\n"
+
+
+def generate_m3u8_playlist(input_file="links.txt", output_file="playlist.m3u8"):
+    try:
+        jobs = parse_links(input_file)
+    except FileNotFoundError:
+        print(f"[FATAL] Missing {input_file}.")
+        sys.exit(1)
+
+    cache = load_cache()
+    hls_list = fetch_hls(jobs, cache)
+    save_cache(cache, {url for _, url in jobs})
+
+    # Encode once; channel names may be non-ASCII, so UTF-8 rather than ASCII
+    with open(output_file, "wb") as out:
+        out.write(emit_playlist(jobs, hls_list).encode("utf-8"))
+
+    added = sum(1 for hls in hls_list if hls)
+    print(f"[DONE] {added}/{len(jobs)} entries produced HLS. Wrote '{output_file}'.")
 
 
 if __name__ == "__main__":
-    generate_m3u8_playlist()
+    try:
+        generate_m3u8_playlist()
+    finally:
+        close_ydls()